@@ -1,4 +1,5 @@
 from .grammar import Parser
+from .cache import DiskCache
 from .nodes import Node, WordNode, PhraseNode, FieldNode, OrNode, AndNode, NotNode, MustNode, RangeNode
 
 parse = Parser()
@@ -0,0 +1,351 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import types
+import weakref
+import zlib
+import pyparsing as pp
+
+
+SCHEMA_VERSION = 1
+
+# connections inherited from a parent process. The child must never use or
+# close them (closing a WAL connection can checkpoint and delete the -wal file
+# out from under the parent), so they are kept referenced here forever
+_inherited = []
+
+
+def _hash_code(digest, code):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(digest, const)
+        elif isinstance(const, frozenset):
+            # the iteration order of a set of strings changes between runs
+            digest.update(repr(sorted(const, key=repr)).encode())
+        else:
+            digest.update(repr(const).encode())
+
+
+def _hash_object(digest, obj):
+    if isinstance(obj, (classmethod, staticmethod)):
+        obj = obj.__func__
+    if isinstance(obj, property):
+        for func in (obj.fget, obj.fset, obj.fdel):
+            if func is not None:
+                _hash_code(digest, func.__code__)
+    elif isinstance(obj, types.FunctionType):
+        _hash_code(digest, obj.__code__)
+    elif isinstance(obj, (str, int, float, bool, tuple, type(None))):
+        digest.update(repr(obj).encode())
+
+
+def fingerprint(*objects, version=None):
+    """
+    Hash the compiled code of the grammar and the given node classes (and
+    their base classes), plus `version`. If any of them change, so does the
+    fingerprint, which invalidates everything cached under the old one.
+    """
+    from . import grammar, nodes
+
+    digest = hashlib.sha1()
+    digest.update(str(SCHEMA_VERSION).encode())
+    digest.update(pp.__version__.encode())
+    digest.update(repr(version).encode())
+
+    namespaces = []
+    for module in (grammar, nodes):
+        namespaces.append((module.__name__, vars(module)))
+    for obj in objects:
+        namespaces.extend((cls.__qualname__, vars(cls)) for cls in obj.__mro__ if cls is not object)
+
+    for name, namespace in namespaces:
+        digest.update(name.encode())
+        for key in sorted(namespace):
+            if key in ("__file__", "__cached__"):
+                # where the package is installed doesn't matter
+                continue
+            value = namespace[key]
+            if isinstance(value, type):
+                # classes in a module are hashed as their own namespace when
+                # they are node classes (or bases of them)
+                continue
+            digest.update(key.encode())
+            _hash_object(digest, value)
+    return digest.hexdigest()
+
+
+def dumps(query):
+    return zlib.compress(json.dumps(query, separators=(",", ":")).encode())
+
+
+def loads(blob):
+    return json.loads(zlib.decompress(blob).decode())
+
+
+def _opened_in_dead_thread(entry):
+    thread = entry[0]()
+    return thread is None or not thread.is_alive()
+
+
+_caches = weakref.WeakSet()
+
+
+def _after_fork():
+    # the child gets copies of every cache's connections. Park them so they
+    # are never garbage collected (and closed) here, and open new ones
+    for cache in list(_caches):
+        _inherited.extend(connection for thread, connection in cache._connections)
+        cache._connections = []
+        cache._generation += 1
+        # another thread may have held the lock when we forked
+        cache._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class DiskCache():
+    """
+    A persistent cache of translated queries, stored in a SQLite database so it
+    survives restarts and can be shared by several processes.
+
+    Entries are keyed by (fingerprint, default_field, query_string). Bump
+    `version` when something the node classes depend on (but that can't be
+    fingerprinted, like a field mapping in another module) changes. When there
+    are more than `max_entries` rows, the least recently used ones are evicted.
+    The row count is only checked every `EVICT_INTERVAL` inserts, so the cache
+    can briefly hold a few more entries than that.
+
+    The cache is only an optimization, so `timeout` (how long to wait for a
+    lock held by another process) is short. Use a longer one for bulk writes.
+    """
+    EVICT_INTERVAL = 100
+
+    # only bump the access time of an entry on a hit if it is at least this
+    # many seconds stale, so that reads don't turn into a write every time
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, *, max_entries=100000, timeout=0.1, version=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.version = version
+        self._local = threading.local()
+        self._inserts = 0
+        self._lock = threading.Lock()
+        # (weakref to the thread, connection) for every connection opened, so
+        # close() can close them all
+        self._connections = []
+        self._generation = 0
+        _caches.add(self)
+
+    @property
+    def connection(self):
+        # SQLite connections must not be shared across a fork or between
+        # threads, so each thread of each process opens its own. The
+        # generation changes after close() and in a forked child
+        generation, connection = getattr(self._local, "connection", (None, None))
+        if connection is None or generation != self._generation:
+            connection = self._connect()
+        return connection
+
+    def _connect(self):
+        # check_same_thread is off only so close() can close connections
+        # opened by other threads; each connection is still only used by the
+        # thread that opened it
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._release(_opened_in_dead_thread)
+            self._connections.append((weakref.ref(threading.current_thread()), connection))
+        self._local.connection = (self._generation, connection)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    fingerprint TEXT NOT NULL,
+                    default_field TEXT NOT NULL,
+                    query_string TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    accessed INTEGER NOT NULL,
+                    PRIMARY KEY (fingerprint, default_field, query_string)
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        except sqlite3.Error:
+            with self._lock:
+                self._release(lambda entry: entry[1] is connection)
+            self._local.connection = (None, None)
+            raise
+        return connection
+
+    def _release(self, predicate):
+        # close the connections matching predicate. Must hold self._lock
+        keep = []
+        for entry in self._connections:
+            if predicate(entry):
+                entry[1].close()
+            else:
+                keep.append(entry)
+        self._connections = keep
+
+    def get(self, fingerprint, default_field, query_string):
+        row = self.connection.execute(
+            "SELECT value, accessed FROM entries WHERE fingerprint = ? AND default_field = ? AND query_string = ?",
+            (fingerprint, default_field, query_string)
+        ).fetchone()
+        if row is None:
+            return None
+
+        value, accessed = row
+        try:
+            query = loads(value)
+        except (zlib.error, ValueError):
+            # a corrupt entry is a miss, and is dropped so it gets replaced
+            self._execute_quietly(
+                "DELETE FROM entries WHERE fingerprint = ? AND default_field = ? AND query_string = ?",
+                (fingerprint, default_field, query_string)
+            )
+            return None
+
+        now = int(time.time())
+        if now - accessed >= self.TOUCH_INTERVAL:
+            self._execute_quietly(
+                "UPDATE entries SET accessed = ? WHERE fingerprint = ? AND default_field = ? AND query_string = ?",
+                (now, fingerprint, default_field, query_string)
+            )
+        return query
+
+    def _execute_quietly(self, sql, parameters):
+        # for best-effort writes on the read path: if another process holds
+        # the write lock, don't bother
+        try:
+            self.connection.execute(sql, parameters)
+        except sqlite3.OperationalError:
+            pass
+
+    def set(self, fingerprint, default_field, query_string, query):
+        value = dumps(query)
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (fingerprint, default_field, query_string, value, accessed) VALUES (?, ?, ?, ?, ?)",
+                (fingerprint, default_field, query_string, value, int(time.time()))
+            )
+            self._inserts += 1
+            if self._inserts % self.EVICT_INTERVAL == 0:
+                self._evict()
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+
+    def _evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            # evict a little extra so we don't have to delete on every check
+            excess += self.max_entries // 10
+            self.connection.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY accessed LIMIT ?)",
+                (excess,)
+            )
+
+    def clear(self):
+        self.connection.execute("DELETE FROM entries")
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._release(lambda entry: True)
+            # other threads' connections are closed now, so make them open new
+            # ones if the cache is used again
+            self._generation += 1
+
+    def warm(self, parser, query_strings, default_field="_all"):
+        """
+        Parse every query string with `parser` (which must use this cache) so
+        the translations are stored. Returns the number of queries that failed
+        to parse.
+        """
+        failed = 0
+        for query_string in query_strings:
+            # only strip the line terminator, spaces are part of the query
+            query_string = query_string.rstrip("\r\n")
+            if not query_string.strip():
+                continue
+            try:
+                parser(query_string, default_field=default_field)
+            except pp.ParseException:
+                failed += 1
+        return failed
+
+
+def load_parser(path):
+    """
+    Load a parser from a "module:attribute" path. The attribute can be a
+    Parser instance, or a callable that returns one.
+    """
+    from .grammar import Parser
+
+    module_name, _, attribute = path.partition(":")
+    obj = getattr(importlib.import_module(module_name), attribute or "parse")
+    if not isinstance(obj, Parser):
+        obj = obj()
+    return obj
+
+
+def main(argv=None):
+    from .grammar import Parser
+
+    arg_parser = argparse.ArgumentParser(prog="python -m elasticparse.cache")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    warm = subparsers.add_parser("warm", help="fill the cache from a query log (one query per line)")
+    warm.add_argument("cache", help="path to the cache database")
+    warm.add_argument("log", help="path to the query log, or - for stdin")
+    warm.add_argument("--default-field", default="_all")
+    warm.add_argument("--parser", help="module:attribute of the Parser (or a factory for one) to warm the cache for")
+    warm.add_argument("--max-entries", type=int, default=100000)
+    warm.add_argument("--version", help="the version the app passes to DiskCache")
+    warm.add_argument("--timeout", type=float, default=30, help="seconds to wait for the app's writes to the cache")
+    args = arg_parser.parse_args(argv)
+
+    cache = DiskCache(args.cache, max_entries=args.max_entries, timeout=args.timeout, version=args.version)
+    if args.parser:
+        template = load_parser(args.parser)
+        # use the template's own class, so a Parser subclass gets the same
+        # fingerprint (and output) as it does in the app
+        parser = type(template)(
+            field_class=template.field_class,
+            word_class=template.word_class,
+            phrase_class=template.phrase_class,
+            cache=cache,
+        )
+    else:
+        parser = Parser(cache=cache)
+
+    log = sys.stdin if args.log == "-" else open(args.log, encoding="utf-8")
+    try:
+        failed = cache.warm(parser, log, default_field=args.default_field)
+    finally:
+        if log is not sys.stdin:
+            log.close()
+
+    print("%d entries cached, %d queries failed to parse" % (len(cache), failed))
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 import string
 import unittest
 import datetime
+import sqlite3
 import pyparsing as pp
 from .nodes import WordNode, PhraseNode, FieldNode, OrNode, AndNode, MustNode, NotNode, JoinNode, RangeNode, UnaryOperatorNode, MustNotNode
+from .cache import fingerprint
 
 
 def dateify(string, location, tokens):
@@ -105,13 +107,38 @@ def get_parser(phrase_class=PhraseNode, word_class=WordNode, field_class=FieldNo
 
 
 class Parser():
-    def __init__(self, *, field_class=FieldNode, word_class=WordNode, phrase_class=PhraseNode):
+    def __init__(self, *, field_class=FieldNode, word_class=WordNode, phrase_class=PhraseNode, cache=None):
         parser = get_parser(field_class=field_class, word_class=word_class, phrase_class=phrase_class)
         self.query = parser['query']
         self.stack = parser['stack']
         self.field_class = field_class
+        self.word_class = word_class
+        self.phrase_class = phrase_class
+        self.cache = cache
+        if cache is not None:
+            self.fingerprint = fingerprint(type(self), field_class, word_class, phrase_class, version=cache.version)
 
     def __call__(self, query_string, default_field="_all"):
+        if self.cache is None:
+            return self.parse(query_string, default_field)
+
+        # the cache is only an optimization, so if it fails (locked or broken
+        # database, or a query that can't be serialized) just parse
+        try:
+            json_blob = self.cache.get(self.fingerprint, default_field, query_string)
+        except (sqlite3.Error, TypeError, ValueError):
+            json_blob = None
+        if json_blob is not None:
+            return json_blob
+
+        json_blob = self.parse(query_string, default_field)
+        try:
+            self.cache.set(self.fingerprint, default_field, query_string, json_blob)
+        except (sqlite3.Error, TypeError, ValueError):
+            pass
+        return json_blob
+
+    def parse(self, query_string, default_field="_all"):
         self.stack.clear()
         result = self.query.parseString(query_string)
         self.default_field = self.field_class(default_field)
@@ -1,10 +1,14 @@
 import datetime
 import json
+import os
 import pyparsing as pp
+import tempfile
+import threading
 import unittest
 
 from .grammar import get_parser
 from .nodes import WordNode, PhraseNode, FieldNode, OrNode, AndNode, MustNode, NotNode, JoinNode, RangeNode, UnaryOperatorNode
+from .cache import DiskCache, fingerprint, main, _inherited
 from . import parse, Parser
 
 
@@ -168,5 +172,164 @@ class ParserTestCase(unittest.TestCase):
         pretty_print(parse("foo + bar"))
         #print(parse.stack)
 
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cache.db")
+        self.cache = DiskCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+
+    def test_cache(self):
+        parse = Parser(cache=self.cache)
+        expected = Parser()("foo AND bar:>10", default_field="name")
+        self.assertEqual(parse("foo AND bar:>10", default_field="name"), expected)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get(parse.fingerprint, "name", "foo AND bar:>10"), expected)
+        self.assertIsNone(self.cache.get(parse.fingerprint, "_all", "foo AND bar:>10"))
+
+        # a fresh cache on the same file sees the entry
+        cache = DiskCache(self.path)
+        self.assertEqual(Parser(cache=cache)("foo AND bar:>10", default_field="name"), expected)
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+    def test_fingerprint(self):
+        class MyWordNode(WordNode):
+            def to_query(self, field):
+                return {"term": {field.get_name(self): self.token}}
+
+        self.assertEqual(fingerprint(FieldNode, WordNode, PhraseNode), fingerprint(FieldNode, WordNode, PhraseNode))
+        self.assertNotEqual(fingerprint(FieldNode, WordNode, PhraseNode), fingerprint(FieldNode, MyWordNode, PhraseNode))
+
+        Parser(cache=self.cache)("foo")
+        # a different word class must not be served the entry cached above
+        self.assertEqual(Parser(word_class=MyWordNode, cache=self.cache)("foo"), Parser(word_class=MyWordNode)("foo"))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_fingerprint_without_source(self):
+        # classes with no source file still get distinct fingerprints
+        namespace = {"WordNode": WordNode}
+        exec("class A(WordNode):\n    def to_query(self, field):\n        return 1", namespace)
+        exec("class B(WordNode):\n    def to_query(self, field):\n        return 2", namespace)
+        namespace["B"].__qualname__ = "A"
+        self.assertNotEqual(fingerprint(namespace["A"]), fingerprint(namespace["B"]))
+
+    def test_version(self):
+        self.assertNotEqual(
+            Parser(cache=DiskCache(self.path, version=1)).fingerprint,
+            Parser(cache=DiskCache(self.path, version=2)).fingerprint,
+        )
+
+    def test_threads(self):
+        parse = Parser(cache=self.cache)
+        parse("foo")
+        results = []
+        thread = threading.Thread(target=lambda: results.append(parse("bar")))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [Parser()("bar")])
+        self.assertEqual(len(self.cache), 2)
+
+        # close() closes the connection the other thread opened too
+        self.cache.close()
+        self.assertEqual(self.cache._connections, [])
+        self.assertEqual(parse("bar"), Parser()("bar"))
+
+    def test_fork(self):
+        parse = Parser(cache=self.cache)
+        parse("foo")
+        inherited = self.cache.connection
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # the child opens its own connection, and keeps the inherited
+                # one referenced (so it is never closed) even after close()
+                if parse("bar") == Parser()("bar") and self.cache.connection is not inherited:
+                    self.cache.close()
+                    if any(c is inherited for c in _inherited):
+                        code = 0
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+        # the child must not have closed the parent's connection or checkpointed
+        # away the WAL
+        self.assertTrue(os.path.exists(self.path + "-wal"))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(parse("foo"), Parser()("foo"))
+
+    def test_fallback(self):
+        class DateWordNode(WordNode):
+            def to_query(self, field):
+                return {"range": {field.get_name(self): {"gte": datetime.date(2020, 1, 1)}}}
+
+        # a translation that can't be serialized is still returned
+        parse = Parser(word_class=DateWordNode, cache=self.cache)
+        self.assertEqual(parse("foo"), Parser(word_class=DateWordNode)("foo"))
+        self.assertEqual(len(self.cache), 0)
+
+        # so is one when the database is unusable
+        parse = Parser(cache=DiskCache(self.dir.name))
+        self.assertEqual(parse("foo"), Parser()("foo"))
+
+    def test_corrupt(self):
+        parse = Parser(cache=self.cache)
+        parse("foo")
+        self.cache.connection.execute("UPDATE entries SET value = x'0102'")
+        self.assertIsNone(self.cache.get(parse.fingerprint, "_all", "foo"))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(parse("foo"), Parser()("foo"))
+        self.assertEqual(self.cache.get(parse.fingerprint, "_all", "foo"), Parser()("foo"))
+
+    def test_locked(self):
+        parse = Parser(cache=self.cache)
+        parse("foo")
+        self.cache.connection.execute("UPDATE entries SET accessed = 0")
+        other = DiskCache(self.path)
+        other.connection.execute("BEGIN IMMEDIATE")
+        try:
+            # a hit that wants to bump the access time, and a miss, both fall
+            # through quickly while another connection holds the write lock
+            start = datetime.datetime.now()
+            self.assertEqual(parse("foo"), Parser()("foo"))
+            self.assertEqual(parse("bar"), Parser()("bar"))
+            self.assertLess(datetime.datetime.now() - start, datetime.timedelta(seconds=5))
+        finally:
+            other.connection.execute("ROLLBACK")
+            other.close()
+        self.assertEqual(len(self.cache), 1)
+
+    def test_subclass(self):
+        class MyParser(Parser):
+            pass
+
+        self.assertNotEqual(Parser(cache=self.cache).fingerprint, MyParser(cache=self.cache).fingerprint)
+
+    def test_eviction(self):
+        self.cache.max_entries = 10
+        self.cache.EVICT_INTERVAL = 5
+        for i in range(25):
+            self.cache.set("f", "_all", str(i), {"i": i})
+        self.assertLessEqual(len(self.cache), 10)
+        self.assertEqual(self.cache.get("f", "_all", "24"), {"i": 24})
+
+    def test_warm(self):
+        log = os.path.join(self.dir.name, "queries.log")
+        with open(log, "w") as f:
+            f.write("foo\nbar:>10\n\n  \nfoo\n foo \r\n")
+        main(["warm", self.path, log, "--default-field", "name"])
+        self.assertEqual(len(self.cache), 3)
+        parse = Parser(cache=self.cache)
+        self.assertEqual(self.cache.get(parse.fingerprint, "name", "bar:>10"), Parser()("bar:>10", default_field="name"))
+        # surrounding spaces are part of the query
+        self.assertIsNotNone(self.cache.get(parse.fingerprint, "name", " foo "))
+
+
 if __name__ == '__main__':
     unittest.main()